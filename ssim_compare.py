@@ -1,10 +1,15 @@
 import os
 import numpy as np
 from PIL import Image
-from skimage.metrics import structural_similarity as ssim
 import json
 from pathlib import Path
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import orjson  # optional: much faster JSON encoding for large reports
+except ImportError:
+    orjson = None
 
 """
 ssim_compare.py
@@ -30,17 +35,108 @@ Dependencies:
   - Python 3.8+
   - numpy
   - pillow (PIL)
-  - scikit-image
 
 Author: David Oesch
 Date: 2025-11-01
 License: MIT
 """
 
+SSIM_WIN_SIZE = 7  # same sliding window as skimage's structural_similarity default
+SSIM_DATA_RANGE = 255
+
 def load_image(image_path):
-    """Load image and convert to numpy array"""
-    img = Image.open(image_path)
-    return np.array(img)
+    """Load image and convert to numpy array
+
+    np.asarray avoids copying the decoded buffer a second time.
+    """
+    return np.asarray(Image.open(image_path))
+
+def _box_sum(img, win_size):
+    """Sum of every win_size x win_size window fully inside img
+
+    Separable running sum over shifted views, one row pass and one column
+    pass. For int32 products of uint8 pixels the sums are exact and cannot
+    overflow (7² * 255² < 2³¹), whatever the image size.
+    """
+    height, width = img.shape
+    rows = img[:, :width - win_size + 1].copy()
+    for k in range(1, win_size):
+        rows += img[:, k:width - win_size + 1 + k]
+    out = rows[:height - win_size + 1].copy()
+    for k in range(1, win_size):
+        out += rows[k:height - win_size + 1 + k]
+    return out
+
+def _ssim_fast(a, b, win_size=SSIM_WIN_SIZE, data_range=SSIM_DATA_RANGE):
+    """Mean SSIM of two equally sized grayscale images
+
+    Reproduces skimage's structural_similarity defaults (uniform 7x7 window,
+    sample covariance, border windows cropped) without building the full
+    SSIM map or the gradient, so scores and thresholds stay comparable.
+    """
+    if min(a.shape) < win_size:
+        raise ValueError(
+            f"Image of size {a.shape[1]}x{a.shape[0]} is smaller than the "
+            f"{win_size}x{win_size} SSIM window"
+        )
+
+    a = a.astype(np.int32)
+    b = b.astype(np.int32)
+    n = win_size * win_size
+
+    # Window sums stay in exact integer arithmetic; only the means are float
+    mu_a = _box_sum(a, win_size) / n
+    mu_b = _box_sum(b, win_size) / n
+    mu_aa = _box_sum(a * a, win_size) / n
+    mu_bb = _box_sum(b * b, win_size) / n
+    mu_ab = _box_sum(a * b, win_size) / n
+
+    cov_norm = n / (n - 1)
+    var_a = cov_norm * (mu_aa - mu_a * mu_a)
+    var_b = cov_norm * (mu_bb - mu_b * mu_b)
+    cov_ab = cov_norm * (mu_ab - mu_a * mu_b)
+
+    c1 = (0.01 * data_range) ** 2
+    c2 = (0.03 * data_range) ** 2
+    ssim_map = ((2 * mu_a * mu_b + c1) * (2 * cov_ab + c2)) / \
+               ((mu_a * mu_a + mu_b * mu_b + c1) * (var_a + var_b + c2))
+    return float(ssim_map.mean())
+
+def to_grayscale(img):
+    """Average the color channels of an image in integer arithmetic
+
+    Gives the same values as np.mean(img, axis=2).astype(np.uint8) without
+    the float64 temporary.
+    """
+    if img.ndim != 3:
+        return img
+    channel_sum = img.sum(axis=2, dtype=np.uint16)
+    return (channel_sum // img.shape[2]).astype(np.uint8)
+
+def match_image_sizes(img1, img2):
+    """Resize the smaller of two images so both have the same height and width
+
+    Gemini returns 1024x1024 maps for 256x256 tiles (e.g. in
+    output_tiles_ssmi), so pairs often differ in size.
+    """
+    if img1.shape[:2] == img2.shape[:2]:
+        return img1, img2
+
+    # Use the larger dimension as target
+    target_shape = max(img1.shape[0], img2.shape[0]), max(img1.shape[1], img2.shape[1])
+
+    # Resize using PIL for better quality
+    if img1.shape[:2] != target_shape:
+        img1_pil = Image.fromarray(img1)
+        img1_pil = img1_pil.resize((target_shape[1], target_shape[0]), Image.LANCZOS)
+        img1 = np.asarray(img1_pil)
+
+    if img2.shape[:2] != target_shape:
+        img2_pil = Image.fromarray(img2)
+        img2_pil = img2_pil.resize((target_shape[1], target_shape[0]), Image.LANCZOS)
+        img2 = np.asarray(img2_pil)
+
+    return img1, img2
 
 def calculate_ssim(img1, img2):
     """Calculate SSIM between two images
@@ -49,78 +145,63 @@ def calculate_ssim(img1, img2):
         float: SSIM score between -1 and 1 (1 = identical)
     """
     # Convert to grayscale if images are RGB
-    if len(img1.shape) == 3:
-        img1_gray = np.mean(img1, axis=2).astype(np.uint8)
-    else:
-        img1_gray = img1
-
-    if len(img2.shape) == 3:
-        img2_gray = np.mean(img2, axis=2).astype(np.uint8)
-    else:
-        img2_gray = img2
+    img1_gray = to_grayscale(img1)
+    img2_gray = to_grayscale(img2)
 
     # Resize images to same dimensions if needed
-    if img1_gray.shape != img2_gray.shape:
-        print(f"  Resizing images: {img1_gray.shape} and {img2_gray.shape}")
-        # Use the larger dimension as target
-        target_shape = max(img1_gray.shape[0], img2_gray.shape[0]), max(img1_gray.shape[1], img2_gray.shape[1])
-
-        # Resize using PIL for better quality
-        if img1_gray.shape != target_shape:
-            img1_pil = Image.fromarray(img1_gray)
-            img1_pil = img1_pil.resize((target_shape[1], target_shape[0]), Image.LANCZOS)
-            img1_gray = np.array(img1_pil)
-
-        if img2_gray.shape != target_shape:
-            img2_pil = Image.fromarray(img2_gray)
-            img2_pil = img2_pil.resize((target_shape[1], target_shape[0]), Image.LANCZOS)
-            img2_gray = np.array(img2_pil)
+    img1_gray, img2_gray = match_image_sizes(img1_gray, img2_gray)
 
     # Calculate SSIM
-    score, diff = ssim(img1_gray, img2_gray, full=True)
-    return score, diff
+    return _ssim_fast(img1_gray, img2_gray)
+
+def _mean_abs_diff(a, b):
+    """Mean absolute difference of two same-shape uint8 arrays
+
+    max - min is the absolute difference without leaving uint8, and the sum
+    accumulates in uint64, so no float64 copies of the images are made.
+    """
+    diff = np.maximum(a, b)
+    diff -= np.minimum(a, b)
+    return float(np.sum(diff, dtype=np.uint64)) / diff.size
 
 def calculate_color_difference(img1, img2):
     """Calculate mean absolute difference in RGB space"""
     if len(img1.shape) == 3 and len(img2.shape) == 3:
         # Resize if dimensions don't match
-        if img1.shape != img2.shape:
-            target_shape = max(img1.shape[0], img2.shape[0]), max(img1.shape[1], img2.shape[1])
-
-            if img1.shape[:2] != target_shape:
-                img1_pil = Image.fromarray(img1)
-                img1_pil = img1_pil.resize((target_shape[1], target_shape[0]), Image.LANCZOS)
-                img1 = np.array(img1_pil)
-
-            if img2.shape[:2] != target_shape:
-                img2_pil = Image.fromarray(img2)
-                img2_pil = img2_pil.resize((target_shape[1], target_shape[0]), Image.LANCZOS)
-                img2 = np.array(img2_pil)
-
-        return np.mean(np.abs(img1.astype(float) - img2.astype(float)))
+        img1, img2 = match_image_sizes(img1, img2)
+        return _mean_abs_diff(img1, img2)
     return None
 
-def analyze_tile_pair(original_path, styled_path, ssim_threshold=0.85):
+def analyze_tile_pair(original_path, styled_path, ssim_threshold=0.85, mad_gate=None):
     """Analyze a pair of original and styled images
 
     Args:
         original_path: Path to original satellite image
         styled_path: Path to styled map image
         ssim_threshold: SSIM threshold above which images are considered too similar
+        mad_gate: Optional color difference above which the pair counts as
+            transformed without computing SSIM (ssim_score is then 0.0 and
+            ssim_skipped is True). Disabled by default; calibrate it on your
+            own tiles first, a high color difference does not guarantee a low SSIM.
 
     Returns:
-        dict: Analysis results
+        dict: Analysis results (resized_from holds the original [height, width]
+        of both images if they had to be matched, else None)
     """
-    # Load images
-    img_original = load_image(original_path)
-    img_styled = load_image(styled_path)
-
-    # Calculate SSIM
-    ssim_score, diff_img = calculate_ssim(img_original, img_styled)
-
-    # Calculate color difference
+    # Load images and bring them to a common size once for both metrics
+    img_original, img_styled = load_image(original_path), load_image(styled_path)
+    resized_from = None
+    if img_original.shape[:2] != img_styled.shape[:2]:
+        resized_from = [list(img_original.shape[:2]), list(img_styled.shape[:2])]
+    img_original, img_styled = match_image_sizes(img_original, img_styled)
+
+    # Calculate color difference (cheap, so it runs first and can gate SSIM)
     color_diff = calculate_color_difference(img_original, img_styled)
 
+    # Calculate SSIM unless the color difference already shows a transformation
+    ssim_skipped = mad_gate is not None and color_diff is not None and color_diff > mad_gate
+    ssim_score = 0.0 if ssim_skipped else calculate_ssim(img_original, img_styled)
+
     # Determine if transformation was successful
     transformation_success = ssim_score < ssim_threshold
 
@@ -130,11 +211,22 @@ def analyze_tile_pair(original_path, styled_path, ssim_threshold=0.85):
         'ssim_score': float(ssim_score),
         'color_difference': float(color_diff) if color_diff is not None else None,
         'transformation_success': bool(transformation_success),
+        'ssim_skipped': bool(ssim_skipped),
+        'resized_from': resized_from,
         'status': 'SUCCESS' if transformation_success else 'FAILED - Too similar to input'
     }
 
     return result
 
+def write_json_report(report, output_file):
+    """Write the report as indented JSON, using orjson when it is installed"""
+    if orjson is not None:
+        with open(output_file, 'wb') as f:
+            f.write(orjson.dumps(report, option=orjson.OPT_INDENT_2))
+    else:
+        with open(output_file, 'w') as f:
+            json.dump(report, f, indent=2)
+
 def generate_markdown_report(results, input_dir, output_file='comparison_report.md'):
     """Generate markdown file with image comparisons"""
 
@@ -153,21 +245,21 @@ def generate_markdown_report(results, input_dir, output_file='comparison_report.
             original_rel = os.path.join(input_dir, original_path.name)
             styled_rel = os.path.join(input_dir, styled_path.name)
 
-            ssim_score = result['ssim_score']
+            ssim_text = "skipped" if result.get('ssim_skipped') else f"{result['ssim_score']:.4f}"
             success = result['transformation_success']
 
             # Create status text with color coding
             if success:
-                status = f"✅ **SUCCESS**<br>SSIM: {ssim_score:.4f}"
+                status = f"✅ **SUCCESS**<br>SSIM: {ssim_text}"
                 row_style = ""
             else:
-                status = f"❌ **FAILED**<br>Too similar to input<br>SSIM: {ssim_score:.4f}"
+                status = f"❌ **FAILED**<br>Too similar to input<br>SSIM: {ssim_text}"
                 row_style = ' style="background-color: #ffe6e6;"'
 
             # Write table row
             f.write(f'| <img src="{original_rel}" width="300"> | ')
             f.write(f'<img src="{styled_rel}" width="300"> | ')
-            f.write(f'{ssim_score:.4f} | ')
+            f.write(f'{ssim_text} | ')
             f.write(f'{status} |\n')
 
         f.write("\n---\n\n")
@@ -178,14 +270,27 @@ def generate_markdown_report(results, input_dir, output_file='comparison_report.
 
     print(f"Markdown report saved to: {output_file}")
 
-def analyze_directory(input_dir, ssim_threshold=0.85, output_report='comparison_report.json', output_markdown='comparison_report.md'):
+def _analyze_tile_pair_safe(original_path, styled_path, ssim_threshold, mad_gate):
+    """Run analyze_tile_pair in a worker, returning (result, error) instead of raising"""
+    try:
+        return analyze_tile_pair(original_path, styled_path, ssim_threshold, mad_gate), None
+    except Exception as e:
+        return None, str(e)
+
+def analyze_directory(input_dir, ssim_threshold=0.85, output_report='comparison_report.json', output_markdown='comparison_report.md',
+                      workers=None, mad_gate=None):
     """Analyze all tile pairs in a directory
 
+    Tile pairs are independent, so they are analyzed in parallel worker
+    processes; results are reported in sorted tile order.
+
     Args:
         input_dir: Directory containing original and styled tiles
         ssim_threshold: SSIM threshold for success detection
         output_report: Path to save JSON report
         output_markdown: Path to save Markdown report
+        workers: Number of worker processes (default: os.cpu_count())
+        mad_gate: Optional color difference above which SSIM is skipped (see analyze_tile_pair)
     """
     input_path = Path(input_dir)
 
@@ -201,6 +306,8 @@ def analyze_directory(input_dir, ssim_threshold=0.85, output_report='comparison_
     success_count = 0
     failed_count = 0
 
+    originals = []
+    styleds = []
     for original_file in sorted(original_tiles):
         # Construct styled filename
         styled_file = input_path / f"{original_file.stem}_map.jpeg"
@@ -209,13 +316,33 @@ def analyze_directory(input_dir, ssim_threshold=0.85, output_report='comparison_
             print(f"Warning: No styled version found for {original_file.name}")
             continue
 
-        print(f"\nAnalyzing: {original_file.name}")
+        originals.append(original_file)
+        styleds.append(styled_file)
+
+    workers = workers or os.cpu_count() or 1
+    # Hand out several pairs per task to amortize inter-process overhead
+    chunksize = max(1, len(originals) // (workers * 4))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        outcomes = executor.map(_analyze_tile_pair_safe, originals, styleds,
+                                [ssim_threshold] * len(originals), [mad_gate] * len(originals),
+                                chunksize=chunksize)
+
+        for original_file, (result, error) in zip(originals, outcomes):
+            print(f"\nAnalyzing: {original_file.name}")
+
+            if error is not None:
+                print(f"  Error analyzing {original_file.name}: {error}")
+                continue
 
-        try:
-            result = analyze_tile_pair(original_file, styled_file, ssim_threshold)
             results.append(result)
 
-            print(f"  SSIM Score: {result['ssim_score']:.4f}")
+            if result['resized_from']:
+                print(f"  Resizing images: {tuple(result['resized_from'][0])} and {tuple(result['resized_from'][1])}")
+            if result['ssim_skipped']:
+                print(f"  SSIM Score: skipped (color difference > {mad_gate})")
+            else:
+                print(f"  SSIM Score: {result['ssim_score']:.4f}")
             print(f"  Color Diff: {result['color_difference']:.2f}" if result['color_difference'] else "")
             print(f"  Status: {result['status']}")
 
@@ -224,17 +351,16 @@ def analyze_directory(input_dir, ssim_threshold=0.85, output_report='comparison_
             else:
                 failed_count += 1
 
-        except Exception as e:
-            print(f"  Error analyzing {original_file.name}: {e}")
-
-    # Generate summary
+    # Generate summary (skipped pairs carry no SSIM score)
+    ssim_scores = [r['ssim_score'] for r in results if not r['ssim_skipped']]
     summary = {
         'total_tiles': int(len(results)),
         'successful_transformations': int(success_count),
         'failed_transformations': int(failed_count),
         'success_rate': float(success_count / len(results) if results else 0),
         'ssim_threshold': float(ssim_threshold),
-        'average_ssim': float(np.mean([r['ssim_score'] for r in results]) if results else 0)
+        'average_ssim': float(np.mean(ssim_scores) if ssim_scores else 0),
+        'ssim_skipped': int(len(results) - len(ssim_scores))
     }
 
     # Save JSON report
@@ -243,8 +369,7 @@ def analyze_directory(input_dir, ssim_threshold=0.85, output_report='comparison_
         'tiles': results
     }
 
-    with open(output_report, 'w') as f:
-        json.dump(report, f, indent=2)
+    write_json_report(report, output_report)
 
     # Generate markdown report
     generate_markdown_report(results, input_dir, output_markdown)
@@ -257,20 +382,28 @@ def analyze_directory(input_dir, ssim_threshold=0.85, output_report='comparison_
     print(f"Failed transformations: {summary['failed_transformations']}")
     print(f"Success rate: {summary['success_rate']*100:.1f}%")
     print(f"Average SSIM score: {summary['average_ssim']:.4f}")
+    if mad_gate is not None:
+        # Hit rate of the gate, for calibrating --mad-gate
+        print(f"SSIM skipped by color difference gate: {summary['ssim_skipped']}/{summary['total_tiles']}")
     print(f"\nJSON report saved to: {output_report}")
     print(f"Markdown report saved to: {output_markdown}")
 
     return report
 
-def compare_single_pair(original_path, styled_path, ssim_threshold=0.85):
+def compare_single_pair(original_path, styled_path, ssim_threshold=0.85, mad_gate=None):
     """Compare a single pair of images"""
-    result = analyze_tile_pair(original_path, styled_path, ssim_threshold)
+    result = analyze_tile_pair(original_path, styled_path, ssim_threshold, mad_gate)
 
     print(f"\nComparison Results:")
     print(f"{'='*60}")
     print(f"Original: {result['original']}")
     print(f"Styled: {result['styled']}")
-    print(f"SSIM Score: {result['ssim_score']:.4f}")
+    if result['resized_from']:
+        print(f"Resized from: {tuple(result['resized_from'][0])} and {tuple(result['resized_from'][1])}")
+    if result['ssim_skipped']:
+        print(f"SSIM Score: skipped (color difference > {mad_gate})")
+    else:
+        print(f"SSIM Score: {result['ssim_score']:.4f}")
     if result['color_difference']:
         print(f"Color Difference: {result['color_difference']:.2f}")
     print(f"Status: {result['status']}")
@@ -316,12 +449,25 @@ if __name__ == "__main__":
         default='comparison_report.md',
         help='Output Markdown report filename (default: comparison_report.md)'
     )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=None,
+        help='Number of worker processes for directory mode (default: number of CPUs)'
+    )
+    parser.add_argument(
+        '--mad-gate',
+        type=float,
+        default=None,
+        help='Skip SSIM and count as success when the mean color difference exceeds this value '
+             '(default: disabled; calibrate on your tiles first)'
+    )
 
     args = parser.parse_args()
 
     # Single pair comparison mode
     if args.original and args.styled:
-        compare_single_pair(args.original, args.styled, args.threshold)
+        compare_single_pair(args.original, args.styled, args.threshold, args.mad_gate)
     # Directory batch mode
     else:
-        analyze_directory(args.dir, args.threshold, args.report, args.markdown)
\ No newline at end of file
+        analyze_directory(args.dir, args.threshold, args.report, args.markdown, args.workers, args.mad_gate)
\ No newline at end of file
@@ -1,12 +1,19 @@
 import os
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from itertools import islice
 from PIL import Image
-import re
+
+try:
+    import pyvips  # optional: streams the mosaic instead of holding it in memory
+except ImportError:
+    pyvips = None
 
 # Configuration
 INPUT_DIR = "output_tiles_ssmi_fixed"
 OUTPUT_FILE = "stitched_map.jpeg"
 TILE_SIZE = 256  # pixels
+MAP_SUFFIX = "_map.jpeg"  # styled tiles are named {col}_{row}_map.jpeg
 
 def parse_tile_filename(filename):
     """Extract tile column and row from filename
@@ -14,9 +21,11 @@ def parse_tile_filename(filename):
     Expected format: {col}_{row}_map.jpeg
     Returns: (col, row) or None if invalid
     """
-    match = re.match(r'(\d+)_(\d+)_map\.jpeg$', filename)
-    if match:
-        return int(match.group(1)), int(match.group(2))
+    if not filename.endswith(MAP_SUFFIX):
+        return None
+    col, _, row = filename[:-len(MAP_SUFFIX)].partition('_')
+    if col.isdecimal() and row.isdecimal():
+        return int(col), int(row)
     return None
 
 def find_all_tiles(input_dir):
@@ -25,23 +34,20 @@ def find_all_tiles(input_dir):
     Returns: dict of {(col, row): filepath}, min/max col/row
     """
     tiles = {}
-    min_col = min_row = float('inf')
-    max_col = max_row = float('-inf')
 
-    for filename in os.listdir(input_dir):
-        if filename.endswith('_map.jpeg'):
-            coords = parse_tile_filename(filename)
+    with os.scandir(input_dir) as entries:
+        for entry in entries:
+            coords = parse_tile_filename(entry.name)
             if coords:
-                col, row = coords
-                tiles[(col, row)] = os.path.join(input_dir, filename)
-
-                min_col = min(min_col, col)
-                max_col = max(max_col, col)
-                min_row = min(min_row, row)
-                max_row = max(max_row, row)
+                tiles[coords] = entry.path
 
     if not tiles:
-        raise ValueError(f"No _map.jpeg tiles found in {input_dir}")
+        raise ValueError(f"No {MAP_SUFFIX} tiles found in {input_dir}")
+
+    cols = [col for col, _ in tiles]
+    rows = [row for _, row in tiles]
+    min_col, max_col = min(cols), max(cols)
+    min_row, max_row = min(rows), max(rows)
 
     print(f"Found {len(tiles)} tiles")
     print(f"Column range: {min_col} to {max_col} ({max_col - min_col + 1} tiles)")
@@ -64,37 +70,147 @@ def detect_tile_size(tiles):
             continue
     raise ValueError("Could not detect tile size - no valid tiles found")
 
-def stitch_tiles(tiles, min_col, max_col, min_row, max_row, output_file):
-    """Stitch tiles into a single image"""
+def load_tile(tile_path, tile_width, tile_height):
+    """Decode a tile to an RGB PIL image of the expected size
 
-    # Detect actual tile size from images
-    tile_width, tile_height = detect_tile_size(tiles)
+    draft() lets libjpeg decode to RGB and, for oversized tiles, use its
+    reduced-size IDCT before the final resize.
+    """
+    with Image.open(tile_path) as img:
+        img.draft('RGB', (tile_width, tile_height))
+        img = img.convert('RGB')
+        if img.size != (tile_width, tile_height):
+            img = img.resize((tile_width, tile_height), Image.LANCZOS)
+        return img
 
-    # Calculate output dimensions
-    width = (max_col - min_col + 1) * tile_width
-    height = (max_row - min_row + 1) * tile_height
+def load_tile_vips(tile_path, tile_width, tile_height):
+    """Open a tile as a lazy, sequential-access pyvips image of the expected size
 
-    print(f"Creating stitched image: {width}x{height} pixels")
+    fail_on='error' makes a corrupt or truncated JPEG fail the final write
+    instead of being padded with grey (see write_with_vips).
+    """
+    img = pyvips.Image.new_from_file(tile_path, access='sequential', fail_on='error')
+    if img.hasalpha():
+        img = img.flatten(background=255)
+    if img.bands == 1:
+        img = img.colourspace('srgb')
+    if (img.width, img.height) != (tile_width, tile_height):
+        img = img.resize(tile_width / img.width, vscale=tile_height / img.height)
+    return img
 
-    # Create output image (RGB)
-    output_img = Image.new('RGB', (width, height), (255, 255, 255))
+def stitch_with_vips(tiles, min_col, max_col, min_row, max_row, tile_width, tile_height):
+    """Build the mosaic as a pyvips pipeline
+
+    Nothing is decoded until the result is written. libvips then streams it
+    top to bottom, so peak memory is about one row of tiles instead of the
+    whole canvas.
 
-    # Track statistics
+    Returns: (image, pasted_tiles, missing_tiles)
+    """
+    blank = pyvips.Image.black(tile_width, tile_height, bands=3).invert()  # white
+    images = []
     pasted_tiles = 0
     missing_tiles = []
 
-    # Paste each tile
-    for col in range(min_col, max_col + 1):
-        for row in range(min_row, max_row + 1):
+    # arrayjoin expects tiles in row-major order
+    for row in range(min_row, max_row + 1):
+        for col in range(min_col, max_col + 1):
             if (col, row) in tiles:
+                try:
+                    images.append(load_tile_vips(tiles[(col, row)], tile_width, tile_height))
+                    pasted_tiles += 1
+                    continue
+                except pyvips.Error as e:
+                    print(f"\nError loading tile {col}_{row}: {e}")
+            missing_tiles.append((col, row))
+            images.append(blank)
+
+    output_img = pyvips.Image.arrayjoin(images, across=max_col - min_col + 1)
+    return output_img, pasted_tiles, missing_tiles
+
+def find_corrupt_tiles_vips(tiles):
+    """Fully decode every tile in a thread pool and return the keys that fail"""
+    def check(tile_path):
+        try:
+            pyvips.Image.new_from_file(tile_path, access='sequential', fail_on='error').avg()
+            return None
+        except pyvips.Error as e:
+            return e
+
+    corrupt = []
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        for (col, row), error in zip(tiles, executor.map(check, tiles.values())):
+            if error is not None:
+                print(f"\nError loading tile {col}_{row}: {error}")
+                corrupt.append((col, row))
+    return corrupt
+
+def write_with_vips(tiles, min_col, max_col, min_row, max_row, tile_width, tile_height, output_file):
+    """Build the pyvips mosaic and write it to output_file
+
+    Tiles are only decoded during the write. If that fails, the tiles are
+    checked and the mosaic is written again with the corrupt ones left blank,
+    so they are reported as missing like in the PIL path.
+
+    Returns: (image, pasted_tiles, missing_tiles)
+    """
+    output_img, pasted_tiles, missing_tiles = stitch_with_vips(
+        tiles, min_col, max_col, min_row, max_row, tile_width, tile_height)
+    try:
+        output_img.write_to_file(output_file, Q=95, optimize_coding=True)
+    except pyvips.Error as e:
+        print(f"\nError writing stitched image, checking tiles: {e}")
+        corrupt = find_corrupt_tiles_vips(tiles)
+        if not corrupt:
+            raise
+        readable = {key: path for key, path in tiles.items() if key not in corrupt}
+        output_img, pasted_tiles, missing_tiles = stitch_with_vips(
+            readable, min_col, max_col, min_row, max_row, tile_width, tile_height)
+        output_img.write_to_file(output_file, Q=95, optimize_coding=True)
+    return output_img, pasted_tiles, missing_tiles
+
+def stitch_with_pil(tiles, min_col, max_col, min_row, max_row, tile_width, tile_height):
+    """Decode all tiles into one in-memory RGB image
+
+    Tiles are decoded in a thread pool (libjpeg releases the GIL) and pasted
+    into the output image on the calling thread as they finish.
+
+    Returns: (image, pasted_tiles, missing_tiles)
+    """
+    width = (max_col - min_col + 1) * tile_width
+    height = (max_row - min_row + 1) * tile_height
+
+    # Create output image (RGB, white background)
+    output_img = Image.new('RGB', (width, height), (255, 255, 255))
+
+    # Track statistics; grid cells without a tile file are missing
+    pasted_tiles = 0
+    grid = {(col, row) for col in range(min_col, max_col + 1) for row in range(min_row, max_row + 1)}
+    missing_tiles = sorted(grid - tiles.keys())
+
+    workers = os.cpu_count() or 1
+    remaining = iter(tiles.items())
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # Decode a bounded window of tiles so only a few decoded tiles are
+        # alive next to the output image at any time
+        pending = {
+            executor.submit(load_tile, path, tile_width, tile_height): (col, row)
+            for (col, row), path in islice(remaining, 2 * workers)
+        }
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                col, row = pending.pop(future)
+                for (next_col, next_row), next_path in islice(remaining, 1):
+                    pending[executor.submit(load_tile, next_path, tile_width, tile_height)] = (next_col, next_row)
+
                 # Calculate position in output image
                 x = (col - min_col) * tile_width
                 y = (row - min_row) * tile_height
 
-                # Load and paste tile
                 try:
-                    tile_img = Image.open(tiles[(col, row)])
-                    output_img.paste(tile_img, (x, y))
+                    output_img.paste(future.result(), (x, y))
                     pasted_tiles += 1
 
                     if pasted_tiles % 10 == 0:
@@ -102,8 +218,34 @@ def stitch_tiles(tiles, min_col, max_col, min_row, max_row, output_file):
                 except Exception as e:
                     print(f"\nError loading tile {col}_{row}: {e}")
                     missing_tiles.append((col, row))
-            else:
-                missing_tiles.append((col, row))
+
+    return output_img, pasted_tiles, missing_tiles
+
+def stitch_tiles(tiles, min_col, max_col, min_row, max_row, output_file):
+    """Stitch tiles into a single image
+
+    Uses a streaming pyvips pipeline when pyvips is installed, otherwise an
+    in-memory PIL image. Returns the stitched image (a pyvips.Image in
+    the streaming case, a PIL Image otherwise).
+    """
+
+    # Detect actual tile size from images
+    tile_width, tile_height = detect_tile_size(tiles)
+
+    # Calculate output dimensions
+    width = (max_col - min_col + 1) * tile_width
+    height = (max_row - min_row + 1) * tile_height
+
+    print(f"Creating stitched image: {width}x{height} pixels")
+
+    if pyvips is not None:
+        # The pyvips pipeline is only evaluated while it is written
+        print(f"\nSaving stitched image to: {output_file}")
+        output_img, pasted_tiles, missing_tiles = write_with_vips(
+            tiles, min_col, max_col, min_row, max_row, tile_width, tile_height, output_file)
+    else:
+        output_img, pasted_tiles, missing_tiles = stitch_with_pil(
+            tiles, min_col, max_col, min_row, max_row, tile_width, tile_height)
 
     print(f"\n  Pasted {pasted_tiles}/{len(tiles)} tiles")
 
@@ -115,8 +257,9 @@ def stitch_tiles(tiles, min_col, max_col, min_row, max_row, output_file):
             print(f"    ... and {len(missing_tiles) - 10} more")
 
     # Save output
-    print(f"\nSaving stitched image to: {output_file}")
-    output_img.save(output_file, quality=95)
+    if pyvips is None:
+        print(f"\nSaving stitched image to: {output_file}")
+        output_img.save(output_file, quality=95)
     print(f"✅ Done! Image size: {width}x{height} pixels")
 
     return output_img
@@ -1,24 +1,43 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import xml.etree.ElementTree as ET
 from google import genai
+from google.genai import types, errors
 from PIL import Image
 from io import BytesIO
 import os
 import math
+import json
+import hashlib
 import time
+import threading
+import warnings
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from functools import lru_cache
+from itertools import islice
 from pathlib import Path
 from pyproj import Transformer
 import numpy as np
-from skimage.metrics import structural_similarity as ssim
+from ssim_compare import calculate_ssim
 
 # Configuration
 ZOOM_LEVEL = 26
 WMTS_BASE_URL = "https://wmts.geo.admin.ch/1.0.0/ch.swisstopo.swissimage/default/current/2056"
 OUTPUT_DIR = "output_tiles_ssmi_fixed"
+MANIFEST_FILE = "manifest.json"  # per-tile results in OUTPUT_DIR, used to resume runs
 SECRETS_DIR = "secrets"
 AREA_URL = "https://public.geo.admin.ch/api/kml/files/GOgTC2UBSsWhqx5w2gFGEQ"
 SSIM_THRESHOLD = 0.35
+SSIM_MAX_SIZE = None  # e.g. 128 to box-downsample before SSIM (re-check SSIM_THRESHOLD)
 MAX_RETRY_ATTEMPTS = 3
+MAX_DOWNLOAD_THREADS = 16  # parallel WMTS tile downloads
+PREFETCH_TILES = 32  # tiles downloaded ahead while the current one is styled
+GEMINI_MAX_RPM = 10  # Gemini requests allowed per minute (check your API tier)
+GEMINI_WORKERS = 4  # tiles styled concurrently (still capped by GEMINI_MAX_RPM)
+
+KML_COORDINATES_TAG = '{http://www.opengis.net/kml/2.2}coordinates'
 
 # Swiss coordinate system parameters (EPSG:2056)
 TILE_SIZE = 256  # pixels
@@ -37,6 +56,57 @@ RESOLUTIONS = {
     23: 2, 24: 1.5, 25: 1, 26: 0.5, 27: 0.25, 28: 0.1
 }
 
+
+class RateLimiter:
+    """Allow at most max_per_minute calls in any sliding 60 second window
+
+    Unlike a fixed sleep between calls, bursts are served immediately as
+    long as the window has capacity. Safe to share between threads.
+    """
+
+    def __init__(self, max_per_minute):
+        self.max_per_minute = max_per_minute
+        self.calls = deque()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a call is allowed, then record it"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                while self.calls and now - self.calls[0] >= 60:
+                    self.calls.popleft()
+                if len(self.calls) < self.max_per_minute:
+                    self.calls.append(now)
+                    return
+                wait_time = 60 - (now - self.calls[0])
+            time.sleep(wait_time)
+
+gemini_rate_limiter = RateLimiter(GEMINI_MAX_RPM)
+
+def create_session():
+    """Create an HTTP session that keeps connections alive across downloads
+
+    All tiles come from the same host, so pooled keep-alive connections skip
+    a TCP/TLS handshake per tile. Transient errors and HTTP 429 are retried
+    with exponential backoff, honouring the server's Retry-After header.
+    """
+    retry = Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        respect_retry_after_header=True,
+    )
+    adapter = HTTPAdapter(pool_connections=MAX_DOWNLOAD_THREADS,
+                          pool_maxsize=MAX_DOWNLOAD_THREADS * 2,
+                          max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+SESSION = create_session()
+
 def read_api_key():
     """Read Gemini API key from file"""
     key_path = os.path.join(SECRETS_DIR, 'genai_key.txt')
@@ -64,95 +134,122 @@ def resize_to_match(output_image, reference_image):
     out_width, out_height = output_image.size
 
     if (out_width, out_height) != (ref_width, ref_height):
-        print(f"  Resizing output from {out_width}x{out_height} to {ref_width}x{ref_height}")
         output_image = output_image.resize((ref_width, ref_height), Image.LANCZOS)
 
     return output_image
 
+def ssim_array(image):
+    """Convert a PIL image to the ndarray used for the SSIM check
+
+    If SSIM_MAX_SIZE is set, the image is converted to luma ('L') and
+    box-downsampled when larger than that, which makes the check cheaper
+    but shifts the scores.
+    """
+    if SSIM_MAX_SIZE:
+        image = image.convert('L')
+        if max(image.size) > SSIM_MAX_SIZE:
+            image = image.resize((SSIM_MAX_SIZE, SSIM_MAX_SIZE), Image.Resampling.BOX)
+    return np.asarray(image)
+
 def calculate_ssim_score(img1, img2):
-    """Calculate SSIM between two images
+    """Calculate SSIM between two ndarrays (see ssim_array)
 
     Returns:
         float: SSIM score between -1 and 1 (1 = identical)
     """
-    # Convert PIL images to numpy arrays
-    if isinstance(img1, Image.Image):
-        img1 = np.array(img1)
-    if isinstance(img2, Image.Image):
-        img2 = np.array(img2)
-
-    # Convert to grayscale if images are RGB
-    if len(img1.shape) == 3:
-        img1_gray = np.mean(img1, axis=2).astype(np.uint8)
-    else:
-        img1_gray = img1
-
-    if len(img2.shape) == 3:
-        img2_gray = np.mean(img2, axis=2).astype(np.uint8)
-    else:
-        img2_gray = img2
-
-    # Resize images to same dimensions if needed
-    if img1_gray.shape != img2_gray.shape:
-        target_shape = max(img1_gray.shape[0], img2_gray.shape[0]), max(img1_gray.shape[1], img2_gray.shape[1])
-
-        if img1_gray.shape != target_shape:
-            img1_pil = Image.fromarray(img1_gray)
-            img1_pil = img1_pil.resize((target_shape[1], target_shape[0]), Image.LANCZOS)
-            img1_gray = np.array(img1_pil)
-
-        if img2_gray.shape != target_shape:
-            img2_pil = Image.fromarray(img2_gray)
-            img2_pil = img2_pil.resize((target_shape[1], target_shape[0]), Image.LANCZOS)
-            img2_gray = np.array(img2_pil)
-
-    # Calculate SSIM
-    score, _ = ssim(img1_gray, img2_gray, full=True)
-    return float(score)
+    # Grayscale, resize if needed and compute the mean SSIM (shared with ssim_compare.py)
+    return calculate_ssim(img1, img2)
+
+def open_for_ssim(jpeg_bytes):
+    """Open a JPEG for the SSIM check only
+
+    With SSIM_MAX_SIZE set, libjpeg decodes it straight to grayscale at a
+    reduced scale (draft mode) instead of decoding pixels the check discards.
+    """
+    image = Image.open(BytesIO(jpeg_bytes))
+    if SSIM_MAX_SIZE:
+        image.draft('L', (SSIM_MAX_SIZE, SSIM_MAX_SIZE))
+    return image
 
 def download_kml(kml_url):
-    """Download KML file from URL"""
+    """Start streaming a KML file from URL
+
+    Returns the open response; pass response.raw to parse_kml_bbox so the
+    XML is parsed while it downloads instead of being buffered first.
+    """
     print(f"Downloading KML from: {kml_url}")
-    response = requests.get(kml_url)
+    response = SESSION.get(kml_url, stream=True, timeout=30)
     response.raise_for_status()
-    return response.content
+    # Let urllib3 undo any gzip/deflate transfer encoding while streaming
+    response.raw.decode_content = True
+    return response
+
+@lru_cache(maxsize=None)
+def _get_transformer(src_crs, dst_crs):
+    """Return a cached Transformer; creating one (PROJ database lookups) is costly"""
+    return Transformer.from_crs(src_crs, dst_crs, always_xy=True)
+
+def parse_kml_coordinates(text):
+    """Parse the text of a KML <coordinates> element into an (N, 2) lon/lat array
+
+    Tuples are "lon,lat[,alt]" separated by whitespace. If every tuple has the
+    same width they are parsed in one np.fromstring call; elements mixing 2-D
+    and 3-D tuples fall back to parsing tuple by tuple, which also raises
+    ValueError on a malformed number instead of silently truncating.
+    """
+    tuples = text.split()
+    dims = tuples[0].count(',') + 1
+    if dims >= 2 and all(t.count(',') == dims - 1 for t in tuples):
+        try:
+            with warnings.catch_warnings():
+                # Older NumPy only warns and stops early at a malformed number
+                # (newer NumPy raises); the size check catches the former
+                warnings.simplefilter('ignore', DeprecationWarning)
+                values = np.fromstring(text.replace(',', ' '), sep=' ')
+        except ValueError:
+            values = None
+        if values is not None and values.size == len(tuples) * dims:
+            return values.reshape(-1, dims)[:, :2]
+
+    lonlat = [t.split(',')[:2] for t in tuples if ',' in t]
+    try:
+        return np.array(lonlat, dtype=np.float64).reshape(-1, 2)
+    except ValueError as e:
+        raise ValueError(f"Malformed KML coordinates {text.strip()[:80]!r}: {e}") from None
 
 def parse_kml_bbox(kml_content):
-    """Extract bounding box from KML (WGS84) and convert to Swiss coordinates (EPSG:2056)"""
-    root = ET.fromstring(kml_content)
+    """Extract bounding box from KML (WGS84) and convert to Swiss coordinates (EPSG:2056)
 
-    namespaces = {
-        'kml': 'http://www.opengis.net/kml/2.2',
-        'gx': 'http://www.google.com/kml/ext/2.2'
-    }
-
-    transformer = Transformer.from_crs("EPSG:4326", "EPSG:2056", always_xy=True)
-
-    coords_wgs84 = []
-    for coord_elem in root.findall('.//kml:coordinates', namespaces):
-        coord_text = coord_elem.text.strip()
-        for line in coord_text.split():
-            parts = line.split(',')
-            if len(parts) >= 2:
-                lon, lat = float(parts[0]), float(parts[1])
-                coords_wgs84.append((lon, lat))
-
-    if not coords_wgs84:
+    kml_content may be bytes or a binary file-like object (e.g. a streamed response body).
+    """
+    if isinstance(kml_content, (bytes, bytearray)):
+        kml_content = BytesIO(kml_content)
+
+    coord_arrays = []
+    # Stream the document and drop each element once read, instead of
+    # building the full tree first
+    for _, elem in ET.iterparse(kml_content):
+        if elem.tag == KML_COORDINATES_TAG and elem.text and elem.text.strip():
+            coord_arrays.append(parse_kml_coordinates(elem.text))
+        elem.clear()
+
+    if not coord_arrays:
         raise ValueError("No coordinates found in KML")
 
-    print(f"Found {len(coords_wgs84)} coordinates in KML")
+    coords = np.concatenate(coord_arrays)
+    lons, lats = coords[:, 0], coords[:, 1]
 
-    coords_swiss = []
-    for lon, lat in coords_wgs84:
-        x, y = transformer.transform(lon, lat)
-        coords_swiss.append((x, y))
+    print(f"Found {len(lons)} coordinates in KML")
+
+    # Reproject all coordinates in a single call
+    transformer = _get_transformer("EPSG:4326", "EPSG:2056")
+    xs, ys = transformer.transform(lons, lats)
 
-    xs, ys = zip(*coords_swiss)
     bbox = {
-        'min_x': min(xs),
-        'max_x': max(xs),
-        'min_y': min(ys),
-        'max_y': max(ys)
+        'min_x': float(xs.min()),
+        'max_x': float(xs.max()),
+        'min_y': float(ys.min()),
+        'max_y': float(ys.max())
     }
 
     print(f"Bounding box (EPSG:2056): {bbox}")
@@ -161,42 +258,95 @@ def parse_kml_bbox(kml_content):
     return bbox
 
 def swiss_to_tile(x, y, zoom):
-    """Convert Swiss coordinates (EPSG:2056) to WMTS tile indices"""
+    """Convert Swiss coordinates (EPSG:2056) to WMTS tile indices
+
+    Accepts scalars or arrays; indices are truncated like int().
+    """
     resolution = RESOLUTIONS[zoom]
     tile_width_m = TILE_SIZE * resolution
-    tile_col = int((x - ORIGIN_X) / tile_width_m)
-    tile_row = int((ORIGIN_Y - y) / tile_width_m)
+    tile_col = ((np.asarray(x) - ORIGIN_X) / tile_width_m).astype(np.int64)
+    tile_row = ((ORIGIN_Y - np.asarray(y)) / tile_width_m).astype(np.int64)
     return tile_col, tile_row
 
 def get_tiles_in_bbox(bbox, zoom):
-    """Get all tile indices within bounding box"""
-    min_tile_col, max_tile_row = swiss_to_tile(bbox['min_x'], bbox['min_y'], zoom)
-    max_tile_col, min_tile_row = swiss_to_tile(bbox['max_x'], bbox['max_y'], zoom)
+    """Get all tile indices within bounding box
+
+    Returns:
+        (N, 2) int array of (tile_col, tile_row), column-major like the WMTS grid
+    """
+    cols, rows = swiss_to_tile(
+        [bbox['min_x'], bbox['max_x']], [bbox['min_y'], bbox['max_y']], zoom
+    )
+    min_tile_col, max_tile_col = cols.tolist()
+    max_tile_row, min_tile_row = rows.tolist()
 
     print(f"Tile range - Col: {min_tile_col} to {max_tile_col}, Row: {min_tile_row} to {max_tile_row}")
 
-    tiles = []
-    for tile_col in range(min_tile_col, max_tile_col + 1):
-        for tile_row in range(min_tile_row, max_tile_row + 1):
-            tiles.append((tile_col, tile_row))
+    tile_cols, tile_rows = np.meshgrid(
+        np.arange(min_tile_col, max_tile_col + 1),
+        np.arange(min_tile_row, max_tile_row + 1),
+        indexing='ij'
+    )
+    tiles = np.stack([tile_cols.ravel(), tile_rows.ravel()], axis=1)
 
     print(f"Found {len(tiles)} tiles to process")
     return tiles
 
 def download_tile(tile_col, tile_row, zoom):
-    """Download a WMTS tile"""
+    """Download a WMTS tile
+
+    Returns:
+        Raw JPEG bytes, or None if the download failed or is not an image
+    """
     url = f"{WMTS_BASE_URL}/{zoom}/{tile_col}/{tile_row}.jpeg"
     print(f"Downloading tile: Col={tile_col}, Row={tile_row} from {url}")
 
     try:
-        response = requests.get(url, timeout=30)
+        response = SESSION.get(url, timeout=30)
         response.raise_for_status()
-        return Image.open(BytesIO(response.content))
+        # Identify the image from its header (cheap) so an error page is a failed download
+        Image.open(BytesIO(response.content))
+        return response.content
     except Exception as e:
         print(f"Error downloading tile {tile_col}/{tile_row}: {e}")
         return None
 
-def apply_style_transfer(client, image, prompt, tile_col, tile_row, max_retries=3):
+def iter_downloaded_tiles(tiles, zoom, max_threads=MAX_DOWNLOAD_THREADS, prefetch=PREFETCH_TILES):
+    """Yield (tile_col, tile_row, tile_data) as downloads complete
+
+    Downloads run in a pool of `max_threads` threads while the caller works
+    on the current tile, hiding WMTS latency behind the Gemini calls. At most
+    `prefetch` tiles are downloaded ahead, which bounds memory use. Tiles are
+    yielded in completion order; failed downloads yield None as the data,
+    like download_tile.
+    """
+    remaining = iter(tiles)
+    with ThreadPoolExecutor(max_workers=max_threads) as pool:
+        pending = {
+            pool.submit(download_tile, tile_col, tile_row, zoom): (tile_col, tile_row)
+            for tile_col, tile_row in islice(remaining, prefetch)
+        }
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                tile_col, tile_row = pending.pop(future)
+                # Keep the pipeline full: one new download per finished one
+                for next_col, next_row in islice(remaining, 1):
+                    pending[pool.submit(download_tile, next_col, next_row, zoom)] = (next_col, next_row)
+                yield tile_col, tile_row, future.result()
+
+def image_to_part(image):
+    """Encode a PIL image once as a Gemini request part
+
+    A PIL image passed in `contents` is re-encoded to PNG by the SDK on every
+    request; building the part once lets all attempts for a tile reuse it.
+    """
+    buffer = BytesIO()
+    image.save(buffer, format='PNG')
+    return types.Part.from_bytes(data=buffer.getvalue(), mime_type='image/png')
+
+def apply_style_transfer(client, image, prompt, tile_col, tile_row, max_retries=3, image_part=None):
     """Apply Gemini style transfer to image
 
     Args:
@@ -206,21 +356,30 @@ def apply_style_transfer(client, image, prompt, tile_col, tile_row, max_retries=
         tile_col: Tile column for logging
         tile_row: Tile row for logging
         max_retries: Maximum retry attempts
+        image_part: Pre-encoded request part for image (see image_to_part)
 
     Returns:
         PIL Image or None if failed
+
+    Raises:
+        errors.ClientError: for 4xx errors other than 429, which would fail
+        the same way on every retry
     """
-    print(f"Applying style transfer to tile Col={tile_col}, Row={tile_row}")
+    print(f"[{tile_col}_{tile_row}] Applying style transfer")
+
+    if image_part is None:
+        image_part = image_to_part(image)
 
     # Store original dimensions
     original_width, original_height = image.size
-    print(f"  Input image size: {original_width}x{original_height}")
+    print(f"[{tile_col}_{tile_row}] Input image size: {original_width}x{original_height}")
 
     for attempt in range(max_retries):
         try:
+            gemini_rate_limiter.acquire()
             response = client.models.generate_content(
                 model="gemini-2.5-flash-image",
-                contents=[image, prompt],
+                contents=[image_part, prompt],
             )
 
             image_parts = [
@@ -232,78 +391,181 @@ def apply_style_transfer(client, image, prompt, tile_col, tile_row, max_retries=
             if image_parts:
                 output_image = Image.open(BytesIO(image_parts[0]))
                 output_width, output_height = output_image.size
-                print(f"  Output image size: {output_width}x{output_height}")
+                print(f"[{tile_col}_{tile_row}] Output image size: {output_width}x{output_height}")
 
                 # Resize to match original if dimensions differ
                 if (output_width, output_height) != (original_width, original_height):
-                    print(f"  ⚠️  Dimension mismatch detected!")
+                    print(f"[{tile_col}_{tile_row}] ⚠️  Dimension mismatch detected!")
                     output_image = resize_to_match(output_image, image)
-                    print(f"  ✅ Resized to match input: {output_image.size}")
+                    print(f"[{tile_col}_{tile_row}] ✅ Resized to match input: {output_image.size}")
 
                 return output_image
             else:
-                print(f"No image generated for tile {tile_col}/{tile_row}")
+                print(f"[{tile_col}_{tile_row}] No image generated")
+                return None
+
+        except errors.ClientError as e:
+            # 4xx: only a rate limit (429) is worth retrying; a bad key or
+            # invalid request fails the same way every time
+            if e.code != 429:
+                raise
+            if attempt < max_retries - 1:
+                wait_time = 2 ** attempt * 10
+                print(f"[{tile_col}_{tile_row}] Rate limited on attempt {attempt + 1}, retrying in {wait_time}s: {e}")
+                time.sleep(wait_time)
+            else:
+                print(f"[{tile_col}_{tile_row}] Failed after {max_retries} attempts: {e}")
+                return None
+
+        except errors.ServerError as e:
+            if attempt < max_retries - 1:
+                wait_time = 2 ** attempt * 5
+                print(f"[{tile_col}_{tile_row}] Server error on attempt {attempt + 1}, retrying in {wait_time}s: {e}")
+                time.sleep(wait_time)
+            else:
+                print(f"[{tile_col}_{tile_row}] Failed after {max_retries} attempts: {e}")
                 return None
 
         except Exception as e:
             if attempt < max_retries - 1:
                 wait_time = (attempt + 1) * 10
-                print(f"Error on attempt {attempt + 1}, retrying in {wait_time}s: {e}")
+                print(f"[{tile_col}_{tile_row}] Error on attempt {attempt + 1}, retrying in {wait_time}s: {e}")
                 time.sleep(wait_time)
             else:
-                print(f"Failed to process tile {tile_col}/{tile_row} after {max_retries} attempts: {e}")
+                print(f"[{tile_col}_{tile_row}] Failed after {max_retries} attempts: {e}")
                 return None
 
     return None
 
 def process_tile_with_validation(client, original_image, prompt, prompt_retry, tile_col, tile_row,
-                                  original_path, styled_path, threshold=0.35, max_attempts=3):
+                                  original_path, styled_path, threshold=0.35, max_attempts=3,
+                                  image_part=None, ssim_reference=None):
     """Process a tile with SSIM validation and retry logic
 
-    Ensures output image exactly matches input dimensions and scale.
+    Ensures output image exactly matches input dimensions and scale. The
+    styled tile is only written once: on success, or after the last attempt
+    with the best (lowest SSIM) result. ssim_reference, if given, replaces
+    original_image in the SSIM check (see open_for_ssim).
     """
+    # Decode the SSIM reference once for all attempts
+    reference_array = ssim_array(original_image if ssim_reference is None else ssim_reference)
+
+    # Encode the input once for all attempts
+    if image_part is None:
+        image_part = image_to_part(original_image)
+    best_image = None
+    best_ssim = None
 
     for attempt in range(max_attempts):
         # Use retry prompt after first attempt
         current_prompt = prompt if attempt == 0 else prompt_retry
         prompt_type = "main" if attempt == 0 else "retry"
 
-        print(f"\n  Attempt {attempt + 1}/{max_attempts} using {prompt_type} prompt")
+        print(f"\n[{tile_col}_{tile_row}] Attempt {attempt + 1}/{max_attempts} using {prompt_type} prompt")
 
         # Apply style transfer (includes automatic resizing to match input)
-        styled_image = apply_style_transfer(client, original_image, current_prompt, tile_col, tile_row)
+        styled_image = apply_style_transfer(client, original_image, current_prompt, tile_col, tile_row,
+                                            image_part=image_part)
         if styled_image is None:
-            print(f"  Style transfer failed on attempt {attempt + 1}")
+            print(f"[{tile_col}_{tile_row}] Style transfer failed on attempt {attempt + 1}")
             continue
 
         # Verify dimensions match (double-check)
         orig_size = original_image.size
         styled_size = styled_image.size
         if orig_size != styled_size:
-            print(f"  ⚠️  Final dimension check failed: {styled_size} != {orig_size}")
+            print(f"[{tile_col}_{tile_row}] ⚠️  Final dimension check failed: {styled_size} != {orig_size}")
             styled_image = resize_to_match(styled_image, original_image)
-            print(f"  ✅ Force-resized to: {styled_image.size}")
-
-        # Save styled tile
-        styled_image.save(styled_path, quality=95)
-        print(f"  Saved styled: {styled_path}")
+            print(f"[{tile_col}_{tile_row}] ✅ Force-resized to: {styled_image.size}")
 
-        # Calculate SSIM
-        ssim_score = calculate_ssim_score(original_image, styled_image)
-        print(f"  SSIM Score: {ssim_score:.4f} (threshold: {threshold})")
+        # Calculate SSIM before anything is written to disk
+        ssim_score = calculate_ssim_score(reference_array, ssim_array(styled_image))
+        print(f"[{tile_col}_{tile_row}] SSIM Score: {ssim_score:.4f} (threshold: {threshold})")
 
         # Check if transformation was successful
         if ssim_score < threshold:
-            print(f"  ✅ SUCCESS - Image successfully transformed (SSIM: {ssim_score:.4f})")
+            print(f"[{tile_col}_{tile_row}] ✅ SUCCESS - Image successfully transformed (SSIM: {ssim_score:.4f})")
+            styled_image.save(styled_path, quality=95)
+            print(f"[{tile_col}_{tile_row}] Saved styled: {styled_path}")
             return True, ssim_score
         else:
-            print(f"  ❌ FAILED - Too similar to input (SSIM: {ssim_score:.4f})")
+            print(f"[{tile_col}_{tile_row}] ❌ FAILED - Too similar to input (SSIM: {ssim_score:.4f})")
+            if best_ssim is None or ssim_score < best_ssim:
+                best_image, best_ssim = styled_image, ssim_score
             if attempt < max_attempts - 1:
-                print(f"  Retrying with alternative prompt...")
-                time.sleep(2)
+                print(f"[{tile_col}_{tile_row}] Retrying with alternative prompt...")
 
-    print(f"  ⚠️  All {max_attempts} attempts failed for tile {tile_col}_{tile_row}")
-    return False, ssim_score
+    print(f"[{tile_col}_{tile_row}] ⚠️  All {max_attempts} attempts failed")
+    if best_image is not None:
+        best_image.save(styled_path, quality=95)
+        print(f"[{tile_col}_{tile_row}] Saved closest result (SSIM: {best_ssim:.4f}): {styled_path}")
+    return False, best_ssim
+
+def tile_paths(tile_col, tile_row):
+    """Return (original_path, styled_path) of a tile in OUTPUT_DIR"""
+    return (os.path.join(OUTPUT_DIR, f"{tile_col}_{tile_row}.jpeg"),
+            os.path.join(OUTPUT_DIR, f"{tile_col}_{tile_row}_map.jpeg"))
+
+def prompt_hash(*prompts):
+    """Short hash identifying the prompts a tile was styled with"""
+    return hashlib.sha256('\n'.join(prompts).encode('utf-8')).hexdigest()[:16]
+
+def load_manifest(path):
+    """Load per-tile results of earlier runs ({} if there are none)"""
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def save_manifest(manifest, path):
+    """Write the manifest atomically so an interrupted run never truncates it"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, path)
+
+def is_tile_done(manifest, tile_col, tile_row, current_prompt_hash):
+    """True if a previous run styled this tile successfully with the same prompts"""
+    entry = manifest.get(f"{tile_col}_{tile_row}")
+    if entry is None or not entry['success'] or entry['prompt_hash'] != current_prompt_hash:
+        return False
+    return all(os.path.exists(path) for path in tile_paths(tile_col, tile_row))
+
+def process_tile(client, tile_data, prompt, prompt_retry, tile_col, tile_row):
+    """Save the original tile, then style and validate it (runs in a Gemini worker)
+
+    The downloaded JPEG bytes are written to disk and sent to Gemini as-is;
+    they are only decoded for the pixel work (resizing and SSIM).
+
+    Returns:
+        (success, final_ssim) as returned by process_tile_with_validation,
+        or (False, None) if the tile cannot be decoded
+    """
+    original_path, styled_path = tile_paths(tile_col, tile_row)
+
+    # Decode the SSIM reference first (needed anyway) to catch corrupt tiles
+    try:
+        original_image = Image.open(BytesIO(tile_data))
+        ssim_reference = open_for_ssim(tile_data)
+        ssim_reference.load()
+    except OSError as e:
+        print(f"[{tile_col}_{tile_row}] Cannot decode downloaded tile: {e}")
+        return False, None
+
+    # Save original tile
+    with open(original_path, 'wb') as f:
+        f.write(tile_data)
+    print(f"[{tile_col}_{tile_row}] Saved original: {original_path} ({original_image.size[0]}x{original_image.size[1]})")
+
+    # Process with validation and retry
+    return process_tile_with_validation(
+        client, original_image, prompt, prompt_retry,
+        tile_col, tile_row, original_path, styled_path,
+        threshold=SSIM_THRESHOLD, max_attempts=MAX_RETRY_ATTEMPTS,
+        image_part=types.Part.from_bytes(data=tile_data, mime_type='image/jpeg'),
+        ssim_reference=ssim_reference
+    )
 
 def main():
     # Create output directory
@@ -327,59 +589,105 @@ def main():
 
     # Download and parse KML
     kml_url = AREA_URL
-    kml_content = download_kml(kml_url)
-    bbox = parse_kml_bbox(kml_content)
+    with download_kml(kml_url) as response:
+        bbox = parse_kml_bbox(response.raw)
 
     # Get tiles in bounding box
     tiles = get_tiles_in_bbox(bbox, ZOOM_LEVEL)
 
+    # Skip tiles finished by an earlier run with the same prompts
+    manifest_path = os.path.join(OUTPUT_DIR, MANIFEST_FILE)
+    manifest = load_manifest(manifest_path)
+    current_prompt_hash = prompt_hash(prompt, prompt_retry)
+    todo = [
+        (tile_col, tile_row) for tile_col, tile_row in tiles.tolist()
+        if not is_tile_done(manifest, tile_col, tile_row, current_prompt_hash)
+    ]
+    skipped_tiles = len(tiles) - len(todo)
+    if skipped_tiles:
+        print(f"Skipping {skipped_tiles} tiles already styled (see {manifest_path})")
+
     # Statistics tracking
     total_tiles = len(tiles)
-    successful_tiles = 0
-    failed_tiles = 0
-    retry_needed = 0
-
-    # Process each tile
-    for i, (tile_col, tile_row) in enumerate(tiles):
-        print(f"\n{'='*60}")
-        print(f"Processing tile {i+1}/{total_tiles}: Col={tile_col}, Row={tile_row}")
-        print(f"{'='*60}")
-
-        # Download original tile
-        original_image = download_tile(tile_col, tile_row, ZOOM_LEVEL)
-        if original_image is None:
-            failed_tiles += 1
-            continue
+    failed_downloads = 0
+    results = []  # (success, final_ssim) per styled tile
+    in_flight = {}  # future -> (tile_col, tile_row)
+    auth_errors = []  # 401/403 from Gemini: every further request would fail too
+
+    def record(done):
+        """Tally finished tiles and persist them to the manifest"""
+        if not done:
+            return
+        for future in done:
+            tile_col, tile_row = in_flight.pop(future)
+            if future.cancelled():
+                continue
+            # One failing tile must not stop the run or lose the others' results
+            try:
+                success, final_ssim = future.result()
+            except errors.ClientError as e:
+                print(f"[{tile_col}_{tile_row}] Gemini rejected the request: {e}")
+                if e.code in (401, 403):
+                    auth_errors.append(e)
+                success, final_ssim = False, None
+            except Exception as e:
+                print(f"[{tile_col}_{tile_row}] Error processing tile: {e}")
+                success, final_ssim = False, None
+            results.append((success, final_ssim))
+            manifest[f"{tile_col}_{tile_row}"] = {
+                'success': success,
+                'ssim': final_ssim,
+                'prompt_hash': current_prompt_hash,
+                'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S')
+            }
+        save_manifest(manifest, manifest_path)
+
+    # Pipeline: the download pool prefetches tiles while GEMINI_WORKERS threads
+    # style them; at most 2 * GEMINI_WORKERS tiles wait for a worker at a time
+    with ThreadPoolExecutor(max_workers=GEMINI_WORKERS) as gemini_pool:
+        for i, (tile_col, tile_row, tile_data) in enumerate(iter_downloaded_tiles(todo, ZOOM_LEVEL)):
+            print(f"\n{'='*60}")
+            print(f"Queued tile {skipped_tiles+i+1}/{total_tiles}: [{tile_col}_{tile_row}]")
+            print(f"{'='*60}")
+
+            # Original tile was downloaded by the prefetch pool
+            if tile_data is None:
+                failed_downloads += 1
+                continue
+
+            future = gemini_pool.submit(
+                process_tile, client, tile_data, prompt, prompt_retry, tile_col, tile_row
+            )
+            in_flight[future] = (tile_col, tile_row)
 
-        # Save original tile
-        original_path = os.path.join(OUTPUT_DIR, f"{tile_col}_{tile_row}.jpeg")
-        original_image.save(original_path, quality=95)
-        print(f"Saved original: {original_path} ({original_image.size[0]}x{original_image.size[1]})")
-
-        # Process with validation and retry
-        styled_path = os.path.join(OUTPUT_DIR, f"{tile_col}_{tile_row}_map.jpeg")
-        success, final_ssim = process_tile_with_validation(
-            client, original_image, prompt, prompt_retry,
-            tile_col, tile_row, original_path, styled_path,
-            threshold=SSIM_THRESHOLD, max_attempts=MAX_RETRY_ATTEMPTS
-        )
-
-        if success:
-            successful_tiles += 1
-        else:
-            failed_tiles += 1
-            if final_ssim >= SSIM_THRESHOLD:
-                retry_needed += 1
+            if len(in_flight) >= 2 * GEMINI_WORKERS:
+                wait(in_flight, return_when=FIRST_COMPLETED)
+            record([future for future in in_flight if future.done()])
+
+            if auth_errors:
+                print("\nGemini rejected the API key or its permissions; stopping")
+                for future in in_flight:
+                    future.cancel()
+                break
+
+    record(list(in_flight))
+
+    if auth_errors:
+        raise SystemExit(f"Aborted: {auth_errors[0]} (check {os.path.join(SECRETS_DIR, 'genai_key.txt')})")
 
-        # Rate limiting - wait between tiles
-        time.sleep(2)
+    successful_tiles = skipped_tiles + sum(1 for success, _ in results if success)
+    failed_tiles = failed_downloads + sum(1 for success, _ in results if not success)
+    retry_needed = sum(
+        1 for success, final_ssim in results
+        if not success and final_ssim is not None and final_ssim >= SSIM_THRESHOLD
+    )
 
     # Print final summary
     print(f"\n{'='*60}")
     print("PROCESSING SUMMARY")
     print(f"{'='*60}")
     print(f"Total tiles: {total_tiles}")
-    print(f"Successful transformations: {successful_tiles}")
+    print(f"Successful transformations: {successful_tiles} ({skipped_tiles} from earlier runs)")
     print(f"Failed transformations: {failed_tiles}")
     print(f"Success rate: {successful_tiles/total_tiles*100:.1f}%")
     print(f"Tiles that needed retry: {retry_needed}")